@@ -0,0 +1,62 @@
+"""Append latency benchmark for Squeue
+
+Messages are put in batches, then read and cleaned, so storage keeps
+growing and shrinking. Latency of put() is compared between the default
+mode and the preallocation mode.
+
+Run from the repository root:
+
+    python -m benchmarks.append_latency
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from squeue.squeue import Squeue
+
+
+def measure(rounds, batch, message, **options):
+    """Returns latencies of put() in microseconds"""
+    name = tempfile.NamedTemporaryFile().name
+    queue = Squeue(name, autoclean=False, **options)
+    latencies = []
+    for _ in range(rounds):
+        for _ in range(batch):
+            started = time.perf_counter()
+            queue.put(message)
+            latencies.append((time.perf_counter() - started) * 10 ** 6)
+        while queue.get() is not None:
+            pass
+        queue.clean()
+    os.unlink(name)
+    return latencies
+
+
+def report(title, latencies):
+    """Prints latency statistics"""
+    latencies = sorted(latencies)
+    print("{}: mean {:.2f}us, p50 {:.2f}us, p99 {:.2f}us".format(
+        title, statistics.mean(latencies),
+        latencies[len(latencies) // 2],
+        latencies[int(len(latencies) * .99)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--extent-size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    message = "x" * args.message_size
+    report("default", measure(args.rounds, args.batch, message))
+    report("preallocate", measure(
+        args.rounds, args.batch, message,
+        preallocate=True, extent_size=args.extent_size))
+
+
+if __name__ == "__main__":
+    main()
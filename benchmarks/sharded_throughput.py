@@ -0,0 +1,87 @@
+"""Throughput benchmark for ShardedSqueue
+
+Producer processes put messages without key, so they are spread over
+shards round-robin, while consumer processes read with affinity to own
+shard and steal from others. The same processes are run over one shard
+and over one shard per consumer.
+
+Run from the repository root:
+
+    python -m benchmarks.sharded_throughput
+"""
+import argparse
+from multiprocessing import Event, Process, Queue
+import os
+import tempfile
+import time
+
+from squeue.sharded_squeue import ShardedSqueue
+
+
+def produce(name, shards, messages_count, message):
+    """Puts messages without key"""
+    queue = ShardedSqueue(name, shards)
+    for _ in range(messages_count):
+        queue.put(message)
+
+
+def consume(name, shards, index, produced, counts):
+    """Gets messages until producers are done and queue is empty"""
+    queue = ShardedSqueue(name, shards, affinity=index)
+    count = 0
+    while True:
+        if queue.get() is not None:
+            count += 1
+        elif produced.is_set() and queue.empty():
+            break
+    counts.put(count)
+
+
+def run(processes_count, shards, messages_count, message):
+    """Returns messages per second and number of messages received"""
+    name = tempfile.NamedTemporaryFile().name
+    queue = ShardedSqueue(name, shards)
+    produced = Event()
+    counts = Queue()
+    producers = [
+        Process(target=produce, args=(name, shards, messages_count, message))
+        for _ in range(processes_count)]
+    consumers = [
+        Process(
+            target=consume, args=(name, shards, index, produced, counts))
+        for index in range(processes_count)]
+    started = time.perf_counter()
+    for process in producers + consumers:
+        process.start()
+    for process in producers:
+        process.join()
+    produced.set()
+    received = sum(counts.get() for _ in consumers)
+    for process in consumers:
+        process.join()
+    elapsed = time.perf_counter() - started
+    for shard in queue.shards:
+        os.unlink(shard.name)
+    return received / elapsed, received
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--message-size", type=int, default=64)
+    args = parser.parse_args()
+    message = "x" * args.message_size
+    expected = args.processes * args.messages
+    for shards in (1, args.processes):
+        throughput, received = run(
+            args.processes, shards, args.messages, message)
+        print("{} producers, {} consumers, {} shards: {:.0f} msg/s, "
+              "{}/{} messages received".format(
+                  args.processes, args.processes, shards, throughput,
+                  received, expected))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,3 +16,6 @@ class ExcedeedMessageSizeError(SqueueError):
     pass
 
 
+class IncompatibleFormatError(SqueueError):
+    """Error occures if storage was written in another format"""
+    pass
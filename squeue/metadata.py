@@ -21,12 +21,21 @@ class Metadata(object):
     MESSAGE_OLD_FLAG_SIZE = 1
     """Message old flag length in bits"""
 
-    METADATA_SIZE = (MESSAGE_SIZE_SIZE + MESSAGE_OLD_FLAG_SIZE) // 8
+    MESSAGE_ATTEMPTS_SIZE = 8
+    """Size in bits of info about failed processing attempts"""
+
+    MAX_MESSAGE_ATTEMPTS = 2 ** MESSAGE_ATTEMPTS_SIZE - 1
+    """Max possible number of attempts to write"""
+
+    METADATA_SIZE = (
+        MESSAGE_SIZE_SIZE + MESSAGE_OLD_FLAG_SIZE +
+        MESSAGE_ATTEMPTS_SIZE) // 8
     """Size in bytes of metadata"""
 
-    def __init__(self, message_size, message_old_flag):
+    def __init__(self, message_size, message_old_flag, message_attempts=0):
         self.message_size = message_size
         self.message_old_flag = message_old_flag
+        self.message_attempts = message_attempts
 
     @property
     def full_message_size(self):
@@ -46,15 +55,22 @@ class Metadata(object):
             cls._bytes_to_int(data), min_size=cls.METADATA_SIZE * 8)
         data_dispenser = StringDispenser(binary_metadata)
         message_old_flag = data_dispenser.get(cls.MESSAGE_OLD_FLAG_SIZE)
+        message_attempts_binary = data_dispenser.get(
+            cls.MESSAGE_ATTEMPTS_SIZE)
+        message_attempts = cls._binary_to_int(message_attempts_binary)
         message_size_binary = data_dispenser.get(cls.MESSAGE_SIZE_SIZE)
         message_size = cls._binary_to_int(message_size_binary)
-        return cls(message_size, message_old_flag)
+        return cls(message_size, message_old_flag, message_attempts)
 
     def serialize(self):
         """Serializes instance into bytes"""
         message_size_binary = self._int_to_binary(
             self.message_size, min_size=self.MESSAGE_SIZE_SIZE)
-        metadata_bits = ''.join([self.message_old_flag, message_size_binary])
+        message_attempts_binary = self._int_to_binary(
+            self.message_attempts, min_size=self.MESSAGE_ATTEMPTS_SIZE)
+        metadata_bits = ''.join([
+            self.message_old_flag, message_attempts_binary,
+            message_size_binary])
         return self._int_to_bytes(
             self.METADATA_SIZE, self._binary_to_int(metadata_bits))
 
@@ -109,5 +125,8 @@ class Metadata(object):
         return value.to_bytes(length, byteorder='big')
 
     def __repr__(self):
-        return "Metadata(message_size={!r}, message_old_flag={!r})".format(
-            self.message_size, self.message_old_flag)
+        return (
+            "Metadata(message_size={!r}, message_old_flag={!r}, "
+            "message_attempts={!r})".format(
+                self.message_size, self.message_old_flag,
+                self.message_attempts))
@@ -0,0 +1,119 @@
+"""ShardedSqueue implementation"""
+from contextlib import contextmanager
+import os
+import zlib
+
+from squeue.squeue import Squeue
+
+
+class ShardedSqueue(object):
+    """Named queue spread across several Squeue files"""
+
+    _SHARD_NAME_TEMPLATE = "{name}.{index}"
+    """Template of file name for every shard"""
+
+    def __init__(self, name, shards, affinity=None, **options):
+        """Class constructor
+
+        :param name: name of the queue
+        :type name: str
+        :param shards: number of underlying queue files
+        :type shards: int
+        :param affinity: index of shard consumer reads first
+        :type affinity: int or None
+        :param options: options passed to every shard, process_lock is
+            enabled by default as producers of all processes append to
+            all shards
+        :type options: dict
+        """
+        if shards < 1:
+            raise ValueError("At least one shard required")
+        self.name = name
+        options.setdefault('process_lock', True)
+        self.shards = [
+            Squeue(self._SHARD_NAME_TEMPLATE.format(name=name, index=index),
+                   **options)
+            for index in range(shards)]
+        if affinity is None:
+            affinity = os.getpid()
+        self.affinity = affinity % shards
+        self._next_shard = self.affinity
+
+    def put(self, message, key=None):
+        """Puts message object to the queue
+
+        Messages with the same key always go to the same shard, so their
+        order is preserved. Messages without key are spread round-robin.
+
+        :param message: object to put
+        :type message: any
+        :param key: key to choose shard by
+        :type key: str or None
+        """
+        if key is None:
+            index = self._next_shard
+            self._next_shard = (index + 1) % len(self.shards)
+        else:
+            index = self.shard_index(key)
+        self.shards[index].put(message)
+
+    def get(self):
+        """Returns message from the queue
+
+        Shard of affinity is read first, other shards are read only if it
+        is empty.
+
+        :returns: next message from the queue or None
+        :rtype: str
+        """
+        for shard in self._get_shards_by_affinity():
+            message = shard.get()
+            if message is not None:
+                return message
+
+    @contextmanager
+    def processing(self):
+        """Yields message from the queue to process
+
+        Failed message is returned to its shard, see Squeue.processing.
+
+        :returns: next message from the queue or None
+        :rtype: str
+        """
+        for shard in self._get_shards_by_affinity():
+            with shard.processing() as message:
+                if message is not None:
+                    yield message
+                    return
+        yield None
+
+    def empty(self):
+        """Checks if there is not unprocessed messages in the queue
+
+        :returns: if any messages in queue to process
+        :rtype: bool
+        """
+        return all(shard.empty() for shard in self.shards)
+
+    def clean(self):
+        """Deletes old messages from all shards"""
+        for shard in self.shards:
+            shard.clean()
+
+    def shard_index(self, key):
+        """Returns index of shard for the key
+
+        :param key: key to choose shard by
+        :type key: str
+        :returns: index of shard
+        :rtype: int
+        """
+        return zlib.crc32(str.encode(key)) % len(self.shards)
+
+    def _get_shards_by_affinity(self):
+        """Returns shards starting from the shard of affinity
+
+        :returns: shards in order to read
+        :rtype: list
+        """
+        return self.shards[self.affinity:] + self.shards[:self.affinity]
@@ -1,17 +1,43 @@
 """Squeue implementation"""
+from contextlib import contextmanager
+import fcntl
+import logging
+import mmap
 import os
+import threading
 
 from squeue import exceptions
 from squeue.metadata import Metadata
 
 
+logger = logging.getLogger(__name__)
+
+
 class Squeue(object):
     """Named queue based on files"""
 
+    _FORMAT_MARKER = b'SQ\x00\x02'
+    """Data identifies layout of header and metadata, changes with them"""
+
+    _FORMAT_MARKER_SIZE = len(_FORMAT_MARKER)
+    """Size in bytes of format marker"""
+
     _TOKEN_SIZE = 4
     """Size in bytes of data presents version of queue"""
 
-    _START_POSITION = _TOKEN_SIZE
+    _TOKEN_POSITION = _FORMAT_MARKER_SIZE
+    """Position where token starts"""
+
+    _END_POSITION_SIZE = 8
+    """Size in bytes of data presents end of messages"""
+
+    _END_POSITION_POSITION = _TOKEN_POSITION + _TOKEN_SIZE
+    """Position where data presents end of messages starts"""
+
+    _HEADER_SIZE = _END_POSITION_POSITION + _END_POSITION_SIZE
+    """Size in bytes of format marker, token and end of messages"""
+
+    _START_POSITION = _HEADER_SIZE
     """Position where messages start"""
 
     _DEFAULT_AUTOCLEAN = True
@@ -20,6 +46,21 @@ class Squeue(object):
     _DEFAULT_CRITICAL_SIZE = 5 * 1024 * 1024  # 10Mb
     """Size of old messages to execute autoclean"""
 
+    _DEFAULT_PREALLOCATE = False
+    """Default value for preallocate option"""
+
+    _DEFAULT_EXTENT_SIZE = 1024 * 1024  # 1Mb
+    """Size of space allocated for storage at once"""
+
+    _DEFAULT_MAX_ATTEMPTS = 5
+    """Number of failed attempts to move message to dead letter queue"""
+
+    _DEFAULT_PROCESS_LOCK = False
+    """Default value for process_lock option"""
+
+    _allocated_size = 0
+    """Known size of space allocated for storage"""
+
     _read_position = 0
     """Position of next message to read"""
 
@@ -29,19 +70,68 @@ class Squeue(object):
 
     def __init__(
             self, name, autoclean=_DEFAULT_AUTOCLEAN,
-            critical_size=_DEFAULT_CRITICAL_SIZE):
+            critical_size=_DEFAULT_CRITICAL_SIZE,
+            preallocate=_DEFAULT_PREALLOCATE,
+            extent_size=_DEFAULT_EXTENT_SIZE, dead_letter=None,
+            max_attempts=_DEFAULT_MAX_ATTEMPTS,
+            process_lock=_DEFAULT_PROCESS_LOCK):
         """Class constructor
 
         :param name: name of the queue
         :type name: str
+        :param preallocate: if True - storage grows by extents and never
+            shrinks on clean
+        :type preallocate: bool
+        :param extent_size: size in bytes of space to allocate at once
+        :type extent_size: int
+        :param dead_letter: queue for messages failed max_attempts times,
+            if None - such messages are dropped
+        :type dead_letter: Squeue or None
+        :param max_attempts: number of failed attempts to process message
+        :type max_attempts: int
+        :param process_lock: if True - storage file is locked while it is
+            changed, so several processes can put and get messages
+        :type process_lock: bool
         """
         self.name = name
         self.autoclean = autoclean
         self.critical_size = critical_size
+        self.preallocate = preallocate
+        self.extent_size = extent_size
+        self.dead_letter = dead_letter
+        self.max_attempts = max_attempts
+        self.process_lock = process_lock
+        self._lock = threading.Lock()
         self._storage = self._get_storage()
         self._prepare_storage()
+        self._header = self._map_header()
         self._token = self._get_token()
-        self._read_position = self._go_to_start_position()
+        self._read_position = self._START_POSITION
+
+    @property
+    def dead_letter(self):
+        """Queue for messages failed max_attempts times"""
+        return self._dead_letter
+
+    @dead_letter.setter
+    def dead_letter(self, dead_letter):
+        if (dead_letter is not None and
+                os.path.abspath(dead_letter.name) ==
+                os.path.abspath(self.name)):
+            raise ValueError("Queue can't be dead letter queue for itself")
+        self._dead_letter = dead_letter
+
+    @property
+    def max_attempts(self):
+        """Number of failed attempts to move message to dead letter queue"""
+        return self._max_attempts
+
+    @max_attempts.setter
+    def max_attempts(self, max_attempts):
+        if not 1 <= max_attempts <= Metadata.MAX_MESSAGE_ATTEMPTS:
+            raise ValueError("Max attempts should be in range 1..{}".format(
+                Metadata.MAX_MESSAGE_ATTEMPTS))
+        self._max_attempts = max_attempts
 
     def put(self, message):
         """Puts message object to the queue
@@ -49,10 +139,18 @@ class Squeue(object):
         :param message: object to put
         :type message: any
         """
-        self._go_to_end_position()
-        metadata = Metadata(len(message), Metadata.MESSAGE_OLD_FLAG_FALSE)
-        self._write(metadata.serialize())
-        self._write(self._serialize_message(message))
+        self.put_many([message])
+
+    def put_many(self, messages):
+        """Puts several message objects to the queue with a single write
+
+        :param messages: objects to put
+        :type messages: list
+        """
+        data = b''.join(
+            self._serialize_record(message) for message in messages)
+        with self._locked():
+            self._append(data)
 
     def get(self):
         """Returns message from the queue
@@ -60,66 +158,248 @@ class Squeue(object):
         :rerturns: next message from the queue or None
         :rtype: str
         """
-        self._validate_token()
-        self._go_to_position(self._read_position)
-        while not self._is_end_of_file():
-            metadata = self._get_metadata()
-            if metadata.message_old_flag == Metadata.MESSAGE_OLD_FLAG_FALSE:
-                metadata.message_old_flag = Metadata.MESSAGE_OLD_FLAG_TRUE
-                self._write(metadata.serialize())
-                self._read_position += Metadata.METADATA_SIZE
-                message = self._read(metadata.message_size)
-                self._read_position = self._get_position()
-                deserialized_message = self._deserialize_message(message)
-                self._check_critical_size_reached()
-                return deserialized_message
-            self._read_position += metadata.full_message_size
-            self._go_to_position(self._read_position)
+        record = self._take()
+        if record is not None:
+            return record[-1]
+
+    @contextmanager
+    def processing(self):
+        """Yields message from the queue to process
+
+        If processing raises an exception, the message is appended to the
+        queue again with attempts counter incremented. Message failed
+        max_attempts times is put to dead letter queue or dropped if there
+        is no dead letter queue.
+
+        :returns: next message from the queue or None
+        :rtype: str
+        """
+        record = self._take()
+        if record is None:
+            yield None
+            return
+        try:
+            yield record[-1]
+        except Exception:
+            self._retry(*record)
+            raise
 
     def empty(self):
         """Checks if there is not unprocessed messages in the queue
 
+        Messages waiting to be moved to dead letter queue are not counted.
+
         :returns: if any messages in queue to process
         :rtype: bool
         """
-        self._validate_token()
-        self._go_to_position(self._read_position)
-        while not self._is_end_of_file():
-            metadata = self._get_metadata()
-            if metadata.message_old_flag == Metadata.MESSAGE_OLD_FLAG_FALSE:
-                return False
-            self._read_position += metadata.full_message_size
-            self._go_to_position(self._read_position)
-        return True
+        with self._locked():
+            self._validate_token()
+            position = self._read_position
+            while not self._is_end_of_file(position):
+                metadata = self._get_metadata(position)
+                if (metadata.message_old_flag ==
+                        Metadata.MESSAGE_OLD_FLAG_FALSE):
+                    if not self._is_poisoned(metadata):
+                        return False
+                elif position == self._read_position:
+                    self._read_position += metadata.full_message_size
+                position += metadata.full_message_size
+            return True
 
     def clean(self):
         """Deletes old messages from the storage"""
+        with self._locked():
+            self._clean()
+
+    def _clean(self):
+        """Deletes old messages, caller must hold the lock"""
         first_message_position = self._get_first_message_position()
         if first_message_position != self._START_POSITION:
             transfered_data_size = self._transfer_data(first_message_position)
-            self._resize_storage(transfered_data_size + self._TOKEN_SIZE)
+            end_position = self._START_POSITION + transfered_data_size
+            self._set_end_position(end_position)
+            if not self.preallocate:
+                self._resize_storage(end_position)
             self._renew_token()
-            self._read_position = self._go_to_start_position()
+            self._read_position = self._START_POSITION
 
-    def _prepare_storage(self):
-        """Prepare storage if it was just created"""
-        if not self._check_token_is_empty():
-            self._renew_token()
+    def _append(self, data):
+        """Writes data after the last message, caller must hold the lock
+
+        :param data: serialized messages
+        :type data: bytes
+        """
+        end_position = self._get_end_position()
+        new_end_position = end_position + len(data)
+        if self.preallocate:
+            self._validate_token()
+            self._allocate(new_end_position)
+        self._write(end_position, data)
+        self._set_end_position(new_end_position)
+
+    def _take(self):
+        """Claims next message and moves poisoned messages met on the way
+
+        Poisoned messages are put to dead letter queue without holding the
+        lock, so queues being dead letter queues of each other can't
+        deadlock.
+
+        :returns: metadata and message or None
+        :rtype: tuple or None
+        """
+        with self._locked():
+            record, poisoned = self._claim()
+            token = self._token
+        self._move_to_dead_letter(token, poisoned)
+        return record
+
+    def _claim(self):
+        """Flags next message as read, caller must hold the lock
+
+        :returns: claimed metadata and message or None, and positions,
+            metadata and messages of poisoned messages met on the way
+        :rtype: tuple
+        """
+        self._validate_token()
+        poisoned = []
+        record = None
+        while not self._is_end_of_file(self._read_position):
+            position = self._read_position
+            metadata = self._get_metadata(position)
+            self._read_position += metadata.full_message_size
+            if metadata.message_old_flag == Metadata.MESSAGE_OLD_FLAG_FALSE:
+                if self._is_poisoned(metadata):
+                    message = self._read(
+                        position + Metadata.METADATA_SIZE,
+                        metadata.message_size)
+                    poisoned.append((
+                        position, metadata,
+                        self._deserialize_message(message)))
+                    continue
+                metadata.message_old_flag = Metadata.MESSAGE_OLD_FLAG_TRUE
+                self._write(position, metadata.serialize())
+                message = self._read(
+                    position + Metadata.METADATA_SIZE, metadata.message_size)
+                record = (metadata, self._deserialize_message(message))
+                break
+        if record is not None and not poisoned:
+            self._check_critical_size_reached()
+        return record, poisoned
+
+    def _retry(self, metadata, message):
+        """Returns failed message to the queue
 
-    def _check_token_is_empty(self):
-        """Check token exists
+        Message is appended, so readers which have already passed its
+        previous position see it as well. Message failed max_attempts
+        times is put to dead letter queue or dropped.
 
-        :returns: is token exist
+        :param metadata: metadata of message
+        :type metadata: Metadata
+        :param message: message to return
+        :type message: any
+        """
+        attempts = metadata.message_attempts + 1
+        if attempts < self.max_attempts:
+            with self._locked():
+                self._append(self._serialize_record(message, attempts))
+        elif self.dead_letter is not None:
+            self.dead_letter.put(message)
+        else:
+            logger.warning(
+                "Message of queue %s dropped after %d failed attempts",
+                self.name, attempts)
+
+    def _is_poisoned(self, metadata):
+        """Checks if message should be moved to dead letter queue
+
+        :param metadata: metadata of message
+        :type metadata: Metadata
+        :returns: if message failed max_attempts times
         :rtype: bool
         """
-        self._go_to_position(0)
-        return bool(self._read(self._TOKEN_SIZE, peek=True))
+        return (
+            self.dead_letter is not None and
+            metadata.message_attempts >= self.max_attempts)
+
+    def _move_to_dead_letter(self, token, poisoned):
+        """Moves messages to dead letter queue with a single write
+
+        Messages are flagged as read after they are put, under the lock.
+        If storage was cleaned meanwhile, they are left unread and moved
+        again, so a message may reach dead letter queue more than once
+        but is never lost.
+
+        :param token: token of storage when messages were found
+        :type token: bytes
+        :param poisoned: positions, metadata and messages to move
+        :type poisoned: list
+        """
+        if not poisoned:
+            return
+        self.dead_letter.put_many([message for _, _, message in poisoned])
+        with self._locked():
+            if token != self._get_token():
+                return
+            for position, metadata, _ in poisoned:
+                metadata.message_old_flag = Metadata.MESSAGE_OLD_FLAG_TRUE
+                self._write(position, metadata.serialize())
+
+    def _prepare_storage(self):
+        """Prepare storage if it was just created, check its format else
+
+        Header is written under lock of storage file, so header which is
+        short or zeroed may be being written by another process and is
+        read again under the lock.
+        """
+        header = self._read(0, self._HEADER_SIZE)
+        if len(header) < self._HEADER_SIZE or not any(header):
+            with self._storage_lock():
+                header = self._read(0, self._HEADER_SIZE)
+                if not any(header):
+                    header = self._create_header()
+        if (len(header) < self._HEADER_SIZE or
+                header[:self._FORMAT_MARKER_SIZE] != self._FORMAT_MARKER):
+            raise exceptions.IncompatibleFormatError(
+                "Storage {} has unknown format".format(self.name))
+
+    def _create_header(self):
+        """Writes header of new storage with a single write
+
+        :returns: written header
+        :rtype: bytes
+        """
+        token = self._generate_token(self._TOKEN_SIZE)
+        header = b''.join([
+            self._FORMAT_MARKER, token,
+            self._serialize_position(self._START_POSITION)])
+        self._write(0, header)
+        self._token = token
+        return header
+
+    @contextmanager
+    def _locked(self):
+        """Holds lock of instance and, if enabled, lock of storage file"""
+        with self._lock:
+            if not self.process_lock:
+                yield
+                return
+            with self._storage_lock():
+                yield
+
+    @contextmanager
+    def _storage_lock(self):
+        """Holds exclusive lock of storage file shared between processes"""
+        fcntl.flock(self._storage, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._storage, fcntl.LOCK_UN)
 
     def _renew_token(self):
         """Writes new token for queue"""
         token = self._generate_token(self._TOKEN_SIZE)
-        self._go_to_position(0)
-        self._write(token)
+        self._write(self._TOKEN_POSITION, token)
+        self._token = token
 
     @staticmethod
     def _generate_token(size):
@@ -132,50 +412,84 @@ class Squeue(object):
         """
         return os.urandom(size)
 
+    def _map_header(self):
+        """Maps header of storage into memory
+
+        Mapping is shared with other processes, so token renewed and
+        messages appended by them are visible without reading the file.
+
+        :returns: mapped header
+        :rtype: mmap.mmap
+        """
+        if os.fstat(self._storage).st_size < self._HEADER_SIZE:
+            raise exceptions.NoTokenFoundError("No token found")
+        return mmap.mmap(self._storage, self._HEADER_SIZE)
+
     def _get_token(self):
         """Returns token of phisical storage
 
         :returns: storage's token
         :rtype: bytes
         """
-        self._go_to_position(0)
-        token = self._read(self._TOKEN_SIZE)
-        if not token:
-            raise exceptions.NoTokenFoundError("No token found")
-        return token
+        return self._header[self._TOKEN_POSITION:self._END_POSITION_POSITION]
 
     def _validate_token(self):
-        """Checks if queue wasn't renewed"""
-        if self._token != self._get_token():
+        """Checks if queue wasn't renewed
+
+        Renewed storage may be truncated by instance without
+        preallocation, so known allocated size is dropped as well.
+        """
+        token = self._get_token()
+        if self._token != token:
+            self._token = token
             self._read_position = self._START_POSITION
+            self._allocated_size = 0
 
-    def _get_metadata(self):
-        """Reads metadata for next message"""
-        metadata_info = self._read(Metadata.METADATA_SIZE, peek=True)
+    def _get_metadata(self, position):
+        """Reads metadata of message
+
+        :param position: position where message starts
+        :type position: int
+        """
+        metadata_info = self._read(position, Metadata.METADATA_SIZE)
         return Metadata.deserialize(metadata_info)
 
-    def _read(self, length, peek=False):
+    def _read(self, position, length):
         """Read portion of data from storage
 
+        :param position: position to read from
+        :type position: int
         :param length: length in bytes of data
         :type length: int
-        :param peek: if True - cursor position doesn't changes
-        :type peek: bool
         :returns: data from file
         :rtype: bytes
         """
-        data = os.read(self._storage, length)
-        if peek:
-            self._go_to_position(self._get_position() - len(data))
-        return data
+        return os.pread(self._storage, length, position)
 
-    def _write(self, value):
+    def _write(self, position, value):
         """Writes bytes value into file
 
+        :param position: position to write to
+        :type position: int
         :param value: value to write
-        :type value: int
+        :type value: bytes
+        """
+        return os.pwrite(self._storage, value, position)
+
+    def _serialize_record(self, message, attempts=0):
+        """Converts message with its metadata into bytes array
+
+        :param message: message to send
+        :type message: any
+        :param attempts: number of failed attempts to process message
+        :type attempts: int
+        :returns: byte representation of the record
+        :rtype: bytes
         """
-        return os.write(self._storage, value)
+        data = self._serialize_message(message)
+        metadata = Metadata(
+            len(data), Metadata.MESSAGE_OLD_FLAG_FALSE, attempts)
+        return metadata.serialize() + data
 
     @staticmethod
     def _serialize_message(message):
@@ -199,50 +513,77 @@ class Squeue(object):
         """
         return data.decode()
 
-    def _get_position(self):
-        """Returns current position
+    def _get_end_position(self):
+        """Returns position where messages end
 
-        :returns: current cursor position
+        :returns: end of messages
         :rtype: int
         """
-        return os.lseek(self._storage, 0, os.SEEK_CUR)
+        return self._deserialize_position(
+            self._header[self._END_POSITION_POSITION:self._HEADER_SIZE])
 
-    def _go_to_position(self, position):
-        """Changes cursor position
+    def _set_end_position(self, position):
+        """Stores position where messages end
 
-        :param position: new position for cursor
+        :param position: end of messages
         :type position: int
         """
-        return os.lseek(self._storage, position, os.SEEK_SET)
+        self._header[self._END_POSITION_POSITION:self._HEADER_SIZE] = (
+            self._serialize_position(position))
 
-    def _go_to_start_position(self, offset=0):
-        """Moves cursot to the start
+    @classmethod
+    def _serialize_position(cls, position):
+        """Converts position into bytes
 
-        :param offset: offset in bytes from the start
-        :type offset: int
+        :param position: position in storage
+        :type position: int
+        :returns: byte representation of position
+        :rtype: bytes
         """
-        return os.lseek(self._storage, self._TOKEN_SIZE + offset, os.SEEK_SET)
+        return position.to_bytes(cls._END_POSITION_SIZE, byteorder='big')
 
-    def _go_to_end_position(self, offset=0):
-        """Moves cursot to the start
+    @staticmethod
+    def _deserialize_position(data):
+        """Converts bytes into position
 
-        :param offset: offset in bytes from the start
-        :type offset: int
+        :param data: byte representation of position
+        :type data: bytes
+        :returns: position in storage
+        :rtype: int
         """
-        return os.lseek(self._storage, offset, os.SEEK_END)
+        return int.from_bytes(data, byteorder='big')
 
-    def _is_end_of_file(self):
-        """Checks if there is no messages in the storage
+    def _is_end_of_file(self, position):
+        """Checks if there is no messages in the storage after position
 
+        :param position: position to check
+        :type position: int
         :returns: is end of file reached
         :rtype: bool
         """
-        return not self._read(Metadata.METADATA_SIZE, peek=True)
+        return position >= self._get_end_position()
+
+    def _allocate(self, size):
+        """Allocates space for storage by extents
+
+        :param size: size in bytes storage should fit
+        :type size: int
+        """
+        if size <= self._allocated_size:
+            return
+        self._allocated_size = os.fstat(self._storage).st_size
+        if size <= self._allocated_size:
+            return
+        allocated_size = -(-size // self.extent_size) * self.extent_size
+        os.posix_fallocate(
+            self._storage, self._allocated_size,
+            allocated_size - self._allocated_size)
+        self._allocated_size = allocated_size
 
     def _check_critical_size_reached(self):
         """Checks if sum size of old messages reached critical size"""
         if self.autoclean and self._read_position > self.critical_size:
-            self.clean()
+            self._clean()
 
     def _get_first_message_position(self):
         """Returns position of first new message
@@ -250,13 +591,12 @@ class Squeue(object):
         :returns: position of first new message
         :rtype: int
         """
-        read_position = self._go_to_start_position()
-        while not self._is_end_of_file():
-            metadata = self._get_metadata()
+        read_position = self._START_POSITION
+        while not self._is_end_of_file(read_position):
+            metadata = self._get_metadata(read_position)
             if metadata.message_old_flag == Metadata.MESSAGE_OLD_FLAG_FALSE:
                 break
             read_position += metadata.full_message_size
-            self._go_to_position(read_position)
         return read_position
 
     def _transfer_data(self, position, buffer_size=256):
@@ -270,14 +610,14 @@ class Squeue(object):
         :rtype: int
         """
         write_position = self._START_POSITION
-        read_position = self._go_to_position(position)
+        read_position = position
+        end_position = self._get_end_position()
         size_data_transfered = 0
         while True:
-            self._go_to_position(read_position)
-            data = self._read(buffer_size)
+            data = self._read(
+                read_position, min(buffer_size, end_position - read_position))
             if data:
-                self._go_to_position(write_position)
-                size_data = self._write(data)
+                size_data = self._write(write_position, data)
                 read_position += size_data
                 write_position += size_data
                 size_data_transfered += size_data
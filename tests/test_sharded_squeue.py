@@ -0,0 +1,115 @@
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+# pylint: disable=redefined-outer-name
+"""Integration tests for ShardedSqueue"""
+import multiprocessing
+import os
+import tempfile
+
+import pytest
+
+from squeue.sharded_squeue import ShardedSqueue
+
+
+SHARDS_COUNT = 4
+
+
+def put_messages_to_queue(test_queue_name, messages):
+    queue = ShardedSqueue(test_queue_name, SHARDS_COUNT)
+    for message in messages:
+        queue.put(message)
+
+
+@pytest.fixture
+def queue():
+    queue_name = tempfile.NamedTemporaryFile().name
+    queue = ShardedSqueue(queue_name, SHARDS_COUNT, affinity=0)
+    yield queue
+    for shard in queue.shards:
+        os.unlink(shard.name)
+
+
+def test_get_returns_message(queue):
+    string_message = "foo"
+    queue.put(string_message)
+    assert queue.get() == string_message
+
+
+def test_get_returns_none_for_empty_queue(queue):
+    assert queue.get() is None
+
+
+def test_put_spreads_messages_round_robin(queue):
+    for message in range(SHARDS_COUNT):
+        queue.put(str(message))
+    assert not any(shard.empty() for shard in queue.shards)
+
+
+def test_put_with_key_uses_single_shard(queue):
+    key = "spam"
+    for message in range(SHARDS_COUNT):
+        queue.put(str(message), key=key)
+    shard_index = queue.shard_index(key)
+    for index, shard in enumerate(queue.shards):
+        assert shard.empty() == (index != shard_index)
+
+
+def test_get_keeps_order_of_messages_with_same_key(queue):
+    messages = ["spam", "ham", "eggs"]
+    for message in messages:
+        queue.put(message, key="foo")
+    assert [queue.get() for _ in messages] == messages
+
+
+def test_get_reads_shard_of_affinity_first(queue):
+    queue.put("foo")
+    queue.put("bar")
+    second_queue = ShardedSqueue(queue.name, SHARDS_COUNT, affinity=1)
+    assert second_queue.get() == "bar"
+    assert queue.get() == "foo"
+
+
+def test_get_steals_messages_from_other_shards(queue):
+    second_queue = ShardedSqueue(queue.name, SHARDS_COUNT, affinity=2)
+    second_queue.put("foo")
+    assert queue.get() == "foo"
+
+
+def test_empty_checks_all_shards(queue):
+    assert queue.empty()
+    ShardedSqueue(queue.name, SHARDS_COUNT, affinity=3).put("foo")
+    assert not queue.empty()
+    queue.get()
+    assert queue.empty()
+
+
+def test_shard_index_is_stable_between_instances(queue):
+    second_queue = ShardedSqueue(queue.name, SHARDS_COUNT)
+    assert queue.shard_index("foo") == second_queue.shard_index("foo")
+
+
+def test_processing_returns_failed_message_to_its_shard(queue):
+    queue.put("foo", key="spam")
+    with pytest.raises(RuntimeError):
+        with queue.processing() as message:
+            assert message == "foo"
+            raise RuntimeError
+    assert not queue.shards[queue.shard_index("spam")].empty()
+    with queue.processing() as message:
+        assert message == "foo"
+    assert queue.empty()
+
+
+def test_get_returns_messages_put_from_processes(queue):
+    messages = [[str(i) * 10] * 1000 for i in range(4)]
+    processes = [
+        multiprocessing.Process(
+            target=put_messages_to_queue, args=(queue.name, process_messages))
+        for process_messages in messages]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    received = [queue.get() for _ in range(4000)]
+    assert sorted(received) == sorted(sum(messages, []))
+    assert queue.empty()
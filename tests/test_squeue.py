@@ -2,12 +2,15 @@
 # pylint: disable=missing-docstring
 # pylint: disable=redefined-outer-name
 """Integration tests for Squeue"""
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 import os
 import tempfile
+import threading
 
 import pytest
 
+from squeue.exceptions import IncompatibleFormatError, SqueueError
 from squeue.squeue import Squeue
 
 
@@ -19,6 +22,23 @@ def get_data_from_queue(test_queue_name, data_queue):
     data_queue.put(Squeue(test_queue_name).get())
 
 
+def clean_queue(test_queue_name):
+    Squeue(test_queue_name).clean()
+
+
+def open_queue(test_queue_name, errors_queue):
+    try:
+        Squeue(test_queue_name)
+    except SqueueError as error:
+        errors_queue.put(repr(error))
+
+
+def put_messages_to_queue(test_queue_name, messages):
+    queue = Squeue(test_queue_name, process_lock=True)
+    for message in messages:
+        queue.put(message)
+
+
 def get_size(file_path):
     return os.stat(file_path).st_size
 
@@ -177,8 +197,75 @@ def test_clean_updates_read_position(queue):
     assert queue.get() == sixth_message
 
 
+def test_get_detects_clean_from_another_process(queue):
+    queue.put("foo")
+    queue.put("bar")
+    queue.get()
+    clean_process = multiprocessing.Process(
+        target=clean_queue, args=(queue.name,))
+    clean_process.start()
+    clean_process.join()
+    assert queue.get() == "bar"
+    assert queue.empty()
+
+
+def test_processes_open_new_queue_at_the_same_time():
+    processes_count = 4
+    for _ in range(10):
+        queue_name = tempfile.NamedTemporaryFile().name
+        errors_queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=open_queue, args=(queue_name, errors_queue))
+            for _ in range(processes_count)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert errors_queue.empty()
+        queue = Squeue(queue_name)
+        queue.put("foo")
+        assert queue.get() == "foo"
+        os.unlink(queue_name)
+
+
+def test_put_from_processes_with_process_lock(queue):
+    messages = [[str(i) * 10] * 1000 for i in range(4)]
+    processes = [
+        multiprocessing.Process(
+            target=put_messages_to_queue, args=(queue.name, process_messages))
+        for process_messages in messages]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    received = [queue.get() for _ in range(4000)]
+    assert sorted(received) == sorted(sum(messages, []))
+    assert queue.empty()
+
+
+def test_queue_rejects_storage_of_another_format(queue):
+    queue_name = tempfile.NamedTemporaryFile().name
+    with open(queue_name, 'wb') as storage:
+        storage.write(os.urandom(4) + b'\x00\x05hello\x00\x05world')
+    with pytest.raises(IncompatibleFormatError):
+        Squeue(queue_name)
+    os.unlink(queue_name)
+
+
+def test_queue_rejects_storage_with_two_bytes_metadata(queue):
+    queue_name = tempfile.NamedTemporaryFile().name
+    with open(queue_name, 'wb') as storage:
+        storage.write(
+            b'SQ\x00\x01' + os.urandom(4) + (30).to_bytes(8, 'big') +
+            b'\x00\x05hello\x00\x05world')
+    with pytest.raises(IncompatibleFormatError):
+        Squeue(queue_name)
+    os.unlink(queue_name)
+
+
 def test_queue_executes_autoclean_on_critical_size_achived(queue):
-    queue.critical_size = 5
+    queue.critical_size = 20
     queue.autoclean = False
     message = 'foo'
     queue.put(message)
@@ -188,3 +275,225 @@ def test_queue_executes_autoclean_on_critical_size_achived(queue):
     queue.put(message)
     queue.get()
     assert get_size(queue.name) < queue.critical_size
+
+
+def test_put_from_threads_sharing_queue(queue):
+    messages = [str(i) * 10 for i in range(100)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(queue.put, messages))
+    received = [queue.get() for _ in messages]
+    assert sorted(received) == sorted(messages)
+    assert queue.empty()
+
+
+def test_get_from_threads_sharing_queue(queue):
+    messages = [str(i) * 10 for i in range(100)]
+    for message in messages:
+        queue.put(message)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        received = list(executor.map(lambda _: queue.get(), messages))
+    assert sorted(received) == sorted(messages)
+    assert queue.empty()
+
+
+def fail_processing(queue):
+    with pytest.raises(RuntimeError):
+        with queue.processing():
+            raise RuntimeError
+
+
+@pytest.fixture
+def dead_letter_queue(queue):
+    dead_letter_name = tempfile.NamedTemporaryFile().name
+    dead_letter = Squeue(dead_letter_name)
+    queue.dead_letter = dead_letter
+    queue.max_attempts = 2
+    yield dead_letter
+    os.unlink(dead_letter_name)
+
+
+def test_get_returns_non_ascii_message(queue):
+    queue.put("привет")
+    queue.put("foo")
+    assert queue.get() == "привет"
+    assert queue.get() == "foo"
+
+
+def test_put_many_writes_messages_in_order(queue):
+    messages = ["spam", "ham", "eggs"]
+    queue.put_many(messages)
+    assert [queue.get() for _ in messages] == messages
+
+
+def test_processing_yields_message(queue):
+    queue.put("foo")
+    with queue.processing() as message:
+        assert message == "foo"
+    assert queue.empty()
+
+
+def test_processing_yields_none_for_empty_queue(queue):
+    with queue.processing() as message:
+        assert message is None
+
+
+def test_processing_returns_failed_message_to_the_queue(queue):
+    queue.put("foo")
+    queue.put("bar")
+    fail_processing(queue)
+    assert queue.get() == "bar"
+    assert queue.get() == "foo"
+
+
+def test_processing_returns_failed_message_for_another_instance(queue):
+    queue.put_many(["foo", "bar", "baz"])
+    second_queue = Squeue(queue.name)
+    with pytest.raises(RuntimeError):
+        with queue.processing() as message:
+            assert message == "foo"
+            assert second_queue.get() == "bar"
+            raise RuntimeError
+    assert second_queue.get() == "baz"
+    assert not second_queue.empty()
+    assert second_queue.get() == "foo"
+    assert queue.empty()
+
+
+def test_processing_counts_attempts_after_clean(queue, dead_letter_queue):
+    queue.put("foo")
+    queue.put("bar")
+    queue.get()
+    with pytest.raises(RuntimeError):
+        with queue.processing() as message:
+            assert message == "bar"
+            queue.clean()
+            raise RuntimeError
+    fail_processing(queue)
+    assert queue.get() is None
+    assert dead_letter_queue.get() == "bar"
+
+
+def test_processing_puts_failed_message_to_dead_letter(
+        queue, dead_letter_queue):
+    queue.put("foo")
+    for _ in range(queue.max_attempts):
+        fail_processing(queue)
+    assert queue.empty()
+    assert dead_letter_queue.get() == "foo"
+    assert dead_letter_queue.empty()
+
+
+def test_get_moves_poisoned_messages_to_dead_letter(
+        queue, dead_letter_queue):
+    queue.put_many(["foo", "bar"])
+    fail_processing(queue)
+    fail_processing(queue)
+    queue.put("baz")
+    queue.max_attempts = 1
+    assert queue.get() == "baz"
+    assert queue.empty()
+    assert dead_letter_queue.get() == "foo"
+    assert dead_letter_queue.get() == "bar"
+    assert dead_letter_queue.empty()
+
+
+def test_empty_skips_poisoned_messages(queue, dead_letter_queue):
+    queue.put("foo")
+    fail_processing(queue)
+    queue.max_attempts = 1
+    assert queue.empty()
+    assert queue.get() is None
+    assert dead_letter_queue.get() == "foo"
+
+
+def test_queue_rejects_itself_as_dead_letter(queue):
+    with pytest.raises(ValueError):
+        queue.dead_letter = queue
+    with pytest.raises(ValueError):
+        Squeue(queue.name, dead_letter=Squeue(queue.name))
+
+
+@pytest.mark.parametrize("max_attempts", [0, 256])
+def test_queue_rejects_unreachable_max_attempts(queue, max_attempts):
+    with pytest.raises(ValueError):
+        Squeue(queue.name, max_attempts=max_attempts)
+
+
+def test_get_moves_poisoned_messages_between_dead_letter_queues(
+        queue, dead_letter_queue):
+    dead_letter_queue.dead_letter = queue
+    queue.put("foo")
+    dead_letter_queue.put("bar")
+    fail_processing(queue)
+    fail_processing(dead_letter_queue)
+    queue.max_attempts = dead_letter_queue.max_attempts = 1
+    received = []
+    threads = [
+        threading.Thread(
+            target=lambda test_queue=test_queue: received.append(
+                test_queue.get()),
+            daemon=True)
+        for test_queue in (queue, dead_letter_queue)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    received += [queue.get(), dead_letter_queue.get()]
+    assert sorted(filter(None, received)) == ["bar", "foo"]
+
+
+def test_processing_drops_failed_message_without_dead_letter(queue):
+    queue.put("foo")
+    queue.max_attempts = 2
+    fail_processing(queue)
+    fail_processing(queue)
+    assert queue.get() is None
+    assert queue.empty()
+
+
+@pytest.fixture
+def preallocated_queue():
+    queue_name = tempfile.NamedTemporaryFile().name
+    yield Squeue(queue_name, preallocate=True, extent_size=64)
+    os.unlink(queue_name)
+
+
+def test_preallocated_queue_grows_by_extents(preallocated_queue):
+    preallocated_queue.put("foo")
+    assert get_size(preallocated_queue.name) == 64
+    preallocated_queue.put("a" * 60)
+    assert get_size(preallocated_queue.name) == 128
+
+
+def test_preallocated_queue_returns_messages(preallocated_queue):
+    messages = ["spam", "ham", "eggs"]
+    for message in messages:
+        preallocated_queue.put(message)
+    second_queue = Squeue(preallocated_queue.name)
+    assert [second_queue.get() for _ in messages] == messages
+    assert preallocated_queue.get() is None
+    assert preallocated_queue.empty()
+
+
+def test_preallocated_queue_keeps_size_on_clean(preallocated_queue):
+    preallocated_queue.put("foo")
+    preallocated_queue.put("bar")
+    preallocated_queue.get()
+    preallocated_queue.clean()
+    assert get_size(preallocated_queue.name) == 64
+    assert preallocated_queue.get() == "bar"
+    assert preallocated_queue.empty()
+
+
+def test_preallocated_queue_grows_by_extents_after_truncation(
+        preallocated_queue):
+    preallocated_queue.put("foo")
+    preallocated_queue.get()
+    preallocated_queue.put("bar")
+    Squeue(preallocated_queue.name).clean()
+    assert get_size(preallocated_queue.name) < 64
+    preallocated_queue.put("baz")
+    assert get_size(preallocated_queue.name) == 64
+    assert preallocated_queue.get() == "bar"
+    assert preallocated_queue.get() == "baz"